@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 
+import atexit
 import configparser
+import copy
+import mmap
 import os
-import shutil
+import signal
 import smtplib
+import sys
 import time
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from email.message import EmailMessage
 
 from dotenv import load_dotenv
 
@@ -14,56 +20,81 @@ load_dotenv()
 
 
 
-from smb.SMBConnection import SMBConnection
+from smb.base import NotConnectedError, SMBTimeout
+from smb.smb_structs import OperationFailure
+
+import smb_store
 
 # Load the configuration file
 config = configparser.ConfigParser()
 config.read(os.getenv("CONFIG_PATH"))
 
-os.getenv("REFRESH_TOKEN")
-
 # Constants
 SERVER_NAME = os.getenv("IBM_SERVER_NAME")
 SHARE_NAME = os.getenv("IBM_SHARE_NAME")
 USERNAME = os.getenv("IBM_USERNAME")
 PASSWORD = os.getenv("IBM_PASSWORD")
 DOMAIN = ''
-PORT = 445
+
+SMTP_SERVER = os.getenv("SMTP_SERVER")
+SMTP_SENDER_EMAIL = os.getenv("SMTP_SENDER_EMAIL")
+SMTP_SENDER_PASSWORD = os.getenv("SMTP_SENDER_PASSWROD")
+SMTP_MAX_MESSAGES = 100  # Reconnect after this many messages to stay under provider limits
 
 
 # Extract values from the configuration file
 CHECK_INTERVAL = int(config['GENERAL']['check_interval'])
 
-JOBS = [
-    {
-        'job_name': config['JOBS'][f'job{i}_name'],
-        'file_name': config['JOBS'][f'job{i}_file_name'],
-        'folder': config['JOBS'][f'job{i}_folder']
-    }
-    for i in range(1, (len(config['JOBS'].items()) // 3) + 1)  # Assuming each job has 3 items (name, filename, folder)
-]
+
+@dataclass(frozen=True, slots=True)
+class Job:
+    """
+    One upload job from the [JOBS] section of the config file.
+    """
+    name: str
+    file_name: str
+    folder: str
+
+
+# Group the jobN_name / jobN_file_name / jobN_folder keys by N
+job_fields = defaultdict(dict)
+for key, value in config['JOBS'].items():
+    index, _, field = key[len('job'):].partition('_')
+    job_fields[int(index)][field] = value
+JOBS = tuple(Job(**job_fields[i]) for i in sorted(job_fields))
 
 EMAIL_RECIPIENTS = [email.strip() for email in config['EMAIL']['recipients'].split(',')]
 
+# Sender and recipient headers are the same for every notification, so parse them once
+EMAIL_TEMPLATE = EmailMessage()
+EMAIL_TEMPLATE["From"] = SMTP_SENDER_EMAIL
+EMAIL_TEMPLATE["To"] = EMAIL_RECIPIENTS
+
+# Jobs are processed in parallel, each worker thread holding its own smb_store connection
+MAX_WORKERS = max(1, min(len(JOBS), 4))
+
 
-# Define the connection function
-def smb_connect():
+def is_alive(conn):
+    """
+    Check that an open SMB connection still answers an echo request.
+    """
     try:
-        conn = SMBConnection(
-            USERNAME,
-            PASSWORD,
-            "client_machine",
-            SERVER_NAME,
-            domain=DOMAIN,
-            use_ntlm_v2=True,
-            is_direct_tcp=True
-        )
-        connected = conn.connect(SERVER_NAME, PORT)
-        if connected:
-            return conn
-        else:
-            #print(f"Failed to connect to {SERVER_NAME}")
-            return None
+        conn.echo(b'x')
+        return True
+    except (NotConnectedError, SMBTimeout, OperationFailure, OSError):
+        return False
+
+
+def get_thread_connection():
+    """
+    Return the calling thread's SMB connection, reconnecting if it has dropped.
+    """
+    try:
+        conn = smb_store.get_connection(SERVER_NAME, USERNAME, PASSWORD, DOMAIN)
+        if not is_alive(conn):
+            smb_store.discard_connection(SERVER_NAME, USERNAME, DOMAIN)
+            conn = smb_store.get_connection(SERVER_NAME, USERNAME, PASSWORD, DOMAIN)
+        return conn
     except Exception as e:
         print(f"Error: {e}")
         return None
@@ -71,14 +102,11 @@ def smb_connect():
 
 def file_exists(conn, share_name, file_name):
     try:
-        # List the files at the provided path
-        files = conn.listPath(share_name, '/')
-        
-        # Check if the desired file is in the list
-        for file in files:
-            if file.filename == file_name:
-                #print(f"File '{file_name}' exists on the network share.")
-                return True
+        # Ask the server for just this entry instead of listing the whole share
+        conn.getAttributes(share_name, file_name)
+        #print(f"File '{file_name}' exists on the network share.")
+        return True
+    except OperationFailure:
         #print(f"File '{file_name}' does not exist on the network share.")
         return False
     except Exception as e:
@@ -86,60 +114,134 @@ def file_exists(conn, share_name, file_name):
         return False
 
 
-def process_job(conn, job):
-    if not file_exists(conn, SHARE_NAME, job['file_name']):
-        #print(f"Checking for local files in folder {job['folder']} to upload...")
-        local_files = sorted([f for f in os.listdir(job['folder']) if os.path.isfile(os.path.join(job['folder'], f))])
-        if local_files:
-            selected_file = local_files[0]
-            #print(f"Found local file: {local_files[0]}")
-            local_file_path = os.path.join(job['folder'], local_files[0])
-            with open(local_file_path, 'rb') as f:
-                #print(f"Uploading {local_files[0]} to {job['file_name']} on the network share...")
-                conn.storeFile(SHARE_NAME, job['file_name'], f)
-                #print(f"Successfully uploaded {local_files[0]} to {job['file_name']} on the network share.")
-
-            # Create the archive folder if it doesn't exist
-            archive_path = os.path.join(job['folder'], 'archive')
-            if not os.path.exists(archive_path):
-                os.makedirs(archive_path)
-
-            # Move the local file to the archive folder
-            shutil.move(local_file_path, os.path.join(archive_path, local_files[0]))
-            #print(f"Moved local file: {local_files[0]} to the archive folder.")
-
-            # Update remaining files count
-            remaining_files = len(local_files) - 1
-
-            # Send email
-            subject = f"{job['job_name']} File: {selected_file} Uploaded to AS400"
-            body = f"filename: {selected_file}\nhas been uploaded as: {job['file_name']}\nand is ready for processing.\n\nRemaining files in queue folder: {remaining_files}"
-            recipients = EMAIL_RECIPIENTS
-            send_email(subject, body, recipients)
+def scan_local_files(folder):
+    """
+    Return the files queued in a job folder, sorted by name.
+    """
+    # scandir reports the file type with each entry, so no extra stat per file
+    with os.scandir(folder) as entries:
+        return sorted((entry for entry in entries if entry.is_file()), key=lambda entry: entry.name)
 
-        else:
-            print(f"No local files in folder {job['folder']} found to upload.")
 
+def process_job(conn, job, local_files):
+    """
+    Upload the next queued file for a job once the AS400 has picked up the previous one.
+    Returns the (subject, body) of the notification to send, or None if nothing was uploaded.
+    """
+    if file_exists(conn, SHARE_NAME, job.file_name):
+        return None
 
-def send_email(subject, body, to_emails):
-    # Email setup
-    sender_email = os.getenv("SMTP_SENDER_EMAIL")
-    sender_password = os.getenv("SMTP_SENDER_PASSWROD")
+    selected_file = local_files[0].name
+    #print(f"Found local file: {selected_file}")
+    local_file_path = local_files[0].path
+    with open(local_file_path, 'rb') as f:
+        #print(f"Uploading {selected_file} to {job.file_name} on the network share...")
+        # Upload from a read-only mapping so pysmb's chunked reads come straight from
+        # the page cache; empty files cannot be mapped and are sent as-is
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                conn.storeFile(SHARE_NAME, job.file_name, data)
+        else:
+            conn.storeFile(SHARE_NAME, job.file_name, f)
+        #print(f"Successfully uploaded {selected_file} to {job.file_name} on the network share.")
+
+    # Create the archive folder if it doesn't exist
+    archive_path = os.path.join(job.folder, 'archive')
+    os.makedirs(archive_path, exist_ok=True)
+
+    # Move the local file to the archive folder; it sits inside the job folder,
+    # so this is always a same-filesystem rename
+    os.replace(local_file_path, os.path.join(archive_path, selected_file))
+    #print(f"Moved local file: {selected_file} to the archive folder.")
+
+    # Update remaining files count
+    remaining_files = len(local_files) - 1
+
+    # Email notification, sent by the main thread
+    subject = f"{job.name} File: {selected_file} Uploaded to AS400"
+    body = f"filename: {selected_file}\nhas been uploaded as: {job.file_name}\nand is ready for processing.\n\nRemaining files in queue folder: {remaining_files}"
+    return subject, body
+
+
+def run_job(job):
+    """
+    Worker entry point: process a job over this thread's SMB connection.
+    """
+    # Check the local queue first so idle jobs never touch the network
+    #print(f"Checking for local files in folder {job.folder} to upload...")
+    local_files = scan_local_files(job.folder)
+    if not local_files:
+        print(f"No local files in folder {job.folder} found to upload.")
+        return None
 
-    # Set up the MIME
-    message = MIMEMultipart()
-    message["From"] = sender_email
-    message["To"] = ", ".join(to_emails)
+    conn = get_thread_connection()
+    if not conn:
+        print(f"Failed to connect to SMB share for job {job.name}.")
+        return None
+    #print("Connected successfully to SMB share.")
+    return process_job(conn, job, local_files)
+
+
+class SMTPSession:
+    """
+    Lazily opened SMTP session that is reused for every notification.
+    """
+    def __init__(self):
+        self.server = None
+        self.messages_sent = 0
+
+    def get(self):
+        # Rotate the session once it has carried its share of messages
+        if self.server is not None and self.messages_sent >= SMTP_MAX_MESSAGES:
+            self.close()
+
+        # Make sure a cached session is still usable before handing it out
+        if self.server is not None:
+            try:
+                if self.server.noop()[0] != 250:
+                    self.close()
+            except smtplib.SMTPServerDisconnected:
+                self.server = None
+
+        if self.server is None:
+            server = smtplib.SMTP(SMTP_SERVER, 587)
+            server.starttls()  # Encrypts the connection
+            server.login(SMTP_SENDER_EMAIL, SMTP_SENDER_PASSWORD)
+            self.server = server
+            self.messages_sent = 0
+        return self.server
+
+    def send(self, message):
+        try:
+            self.get().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped us between the health check and the send; retry once
+            self.server = None
+            self.get().send_message(message)
+        self.messages_sent += 1
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except smtplib.SMTPException:
+                pass
+            self.server = None
+
+
+SMTP_SESSION = SMTPSession()
+atexit.register(SMTP_SESSION.close)
+
+
+def send_email(subject, body):
+    # Set up the message from the template; a deep copy keeps the template's header list untouched
+    message = copy.deepcopy(EMAIL_TEMPLATE)
     message["Subject"] = subject
-    message.attach(MIMEText(body, 'plain'))
+    message.set_content(body)
 
-    # Connect and send the email
+    # Send the email over the shared session
     try:
-        server = smtplib.SMTP(os.getenv("SMTP_SERVER"), 587)
-        server.starttls()  # Encrypts the connection
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, to_emails, message.as_string())
-        server.close()
+        SMTP_SESSION.send(message)
 
         #print("Email sent successfully")
     except Exception as e:
@@ -149,19 +251,37 @@ def send_email(subject, body, to_emails):
 # Main script logic
 
 def main():
-    while True:
-        #print("Attempting to connect to SMB share...")
-        conn = smb_connect()
-        if conn:
-            #print("Connected successfully to SMB share.")
-            for job in JOBS:
-                process_job(conn, job)
-            conn.close()
-        else:
-            print("Failed to connect to SMB share.")
+    # Turn SIGTERM into a normal exit so the connections below are closed cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-        #print(f"Sleeping for {CHECK_INTERVAL} seconds before next check...")
-        time.sleep(CHECK_INTERVAL)
+    # The pool lives across checks so each worker's SMB session is reused between ticks
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        while True:
+            # Checks start every CHECK_INTERVAL seconds no matter how long the work takes
+            next_check = time.monotonic() + CHECK_INTERVAL
+
+            futures = {executor.submit(run_job, job): job for job in JOBS}
+            for future in as_completed(futures):
+                try:
+                    notification = future.result()
+                except Exception as e:
+                    print(f"Error processing job {futures[future].name}: {e}")
+                    continue
+
+                # Emails go out one at a time over the shared SMTP session
+                if notification:
+                    subject, body = notification
+                    send_email(subject, body)
+
+            remaining = next_check - time.monotonic()
+            if remaining < 0:
+                print(f"Warning: check took {CHECK_INTERVAL - remaining:.1f} seconds, longer than the {CHECK_INTERVAL} second interval")
+            #print(f"Sleeping for {max(0, remaining)} seconds before next check...")
+            time.sleep(max(0, remaining))
+    finally:
+        executor.shutdown(wait=True)
+        smb_store.close_connections()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,12 @@
 import os
-from datetime import datetime
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
 from dotenv import load_dotenv
-from smb.SMBConnection import SMBConnection
 
-from credentials import credentials
+import smb_store
+import sp_api
 
 load_dotenv()
 
@@ -13,7 +14,12 @@ load_dotenv()
 SERVER_NAME = os.getenv("NAS_SERVER_NAME")
 SHARE_NAME = os.getenv("NAS_SHARE_NAME")
 SMB_PATH = os.getenv("NAS_SETTLEMENTS_PATH")
-CLIENT_NAME = "local_machine"  # Can be any identifiable string
+
+# Keep HTTPS connections to Amazon open across every API call
+SESSION = sp_api.create_session()
+
+# Report document URLs expire after five minutes; refetch prefetched ones older than this
+DOCUMENT_URL_MAX_AGE = 4 * 60
 
 # Determine the directory of the current script
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -26,88 +32,79 @@ def get_full_path(filename):
 
 # --- API FUNCTIONS ---
 
-# Get Access Token
-def get_access_token():
-    """
-    Obtain the access token for API authentication.
-    """
-    # Fetch the token using the provided credentials
-    token_response = requests.post(
-        "https://api.amazon.com/auth/o2/token",
-        data={
-            "grant_type": "refresh_token",
-            "refresh_token": os.getenv("REFRESH_TOKEN"),
-            "client_id": os.getenv("LWA_APP_ID"),
-            "client_secret": os.getenv("LWA_CLIENT_SECRET"),
-        },
-    )
-    print("Access Token Retrieved")
-    return token_response.json()["access_token"]
-
 def get_downloaded_report_ids():
     """
     Fetch the list of already downloaded report IDs.
     """
-    # If the settlements-log.txt file doesn't exist, return an empty set.
-    log_path = get_full_path("settlements-log.txt")
-    if not os.path.exists(log_path):
-        return set()
-
     # If the settlements-log.txt file exists, read it line by line,
     # and each line is considered a report ID.
-    with open(log_path, "r") as f:
-        return set(f.read().splitlines())
+    # If it doesn't exist yet, return an empty set.
+    try:
+        with open(get_full_path("settlements-log.txt"), "r") as f:
+            return set(f.read().splitlines())
+    except FileNotFoundError:
+        return set()
 
 
-def download_report(report_document_id, report_id, data_start_time, data_end_time, access_token):
+def get_document_url(report, access_token):
     """
-    Download the report by its ID and save it to a local file.
+    Fetch the download URL of a finished report's document.
+    Return the URL and the time it was fetched.
     """
     headers = {
         "x-amz-access-token": access_token
     }
     
     # Fetch the report's download information
-    response = requests.get(f'https://sellingpartnerapi-na.amazon.com/reports/2021-06-30/documents/{report_document_id}', headers=headers)
+    sp_api.rate_limit("getReportDocument")
+    response = SESSION.get(f'https://sellingpartnerapi-na.amazon.com/reports/2021-06-30/documents/{report["reportDocumentId"]}', headers=headers)
     response.raise_for_status()
     
-    download_url = response.json()['url']
-    
-    # Download the report
-    report_data = requests.get(download_url)
-    report_data.raise_for_status()
+    return sp_api.parse_json(response)['url'], time.monotonic()
+
 
-    # Parse and format the dates to MM-DD-YYYY
-    formatted_start_time = datetime.strptime(data_start_time, "%Y-%m-%dT%H:%M:%S%z").strftime('%m-%d-%Y')
-    formatted_end_time = datetime.strptime(data_end_time, "%Y-%m-%dT%H:%M:%S%z").strftime('%m-%d-%Y')
+def download_report(download_url, report_id, data_start_time, data_end_time):
+    """
+    Download the report from its document URL and save it to a local file.
+    Return the local file path and the name to upload it under.
+    """
+    # Reformat the YYYY-MM-DD date part of the ISO 8601 timestamps to MM-DD-YYYY
+    formatted_start_time = f"{data_start_time[5:7]}-{data_start_time[8:10]}-{data_start_time[0:4]}"
+    formatted_end_time = f"{data_end_time[5:7]}-{data_end_time[8:10]}-{data_end_time[0:4]}"
 
     
     # Ensure the 'settlement-downloads' subfolder exists; if not, create it
     downloads_folder = get_full_path('settlement-downloads')
-    if not os.path.exists(downloads_folder):
-        os.mkdir(downloads_folder)
+    os.makedirs(downloads_folder, exist_ok=True)
 
     # Save the report data to a file with the desired naming convention inside 'settlement-downloads' subfolder
-    filename = os.path.join(downloads_folder, f"disb_{formatted_start_time}_{formatted_end_time}_{report_id}.tsv")
-    with open(filename, "wb") as f:
-        f.write(report_data.content)
-    
-    # Upload to SMB share
-    smb_upload(filename, f"disb_{formatted_start_time}_{formatted_end_time}_{report_id}.tsv")
+    remote_file_name = f"disb_{formatted_start_time}_{formatted_end_time}_{report_id}.tsv"
+    filename = os.path.join(downloads_folder, remote_file_name)
+    # Stream the report to disk as it downloads rather than holding it all in memory
+    with SESSION.get(download_url, stream=True) as report_data:
+        report_data.raise_for_status()
+        report_data.raw.decode_content = True
+        with open(filename, "wb") as f:
+            shutil.copyfileobj(report_data.raw, f, 1 << 20)
+
+    return filename, remote_file_name
 
 
     
-def log_downloaded_report_id(report_id):
+def log_downloaded_report_ids(report_ids):
     """
-    Log a report ID to the external file.
+    Log report IDs to the external file in a single write.
     """
+    if not report_ids:
+        return
+
     # Open the "settlements-log.txt" file in append mode.
     # If the file doesn't exist, it will be created.
     with open(get_full_path("settlements-log.txt"), "a") as f:
-        # Write the provided report ID to the file followed by a newline.
+        # Write each report ID followed by a newline.
         # This newline ensures that each report ID is on a separate line, 
         # making it easier to read and manage the file.
-        f.write(report_id + "\n")
+        f.write("\n".join(report_ids) + "\n")
 
 
 def get_settlement_report(access_token):
@@ -123,7 +120,8 @@ def get_settlement_report(access_token):
     }
     
     # Make a GET request to fetch the specified report type from the API
-    report_response = requests.get(
+    sp_api.rate_limit("getReports")
+    report_response = SESSION.get(
         endpoint + "/reports/2021-06-30/reports?reportTypes=GET_V2_SETTLEMENT_REPORT_DATA_FLAT_FILE_V2",
         headers=headers
     )
@@ -131,28 +129,51 @@ def get_settlement_report(access_token):
     # If the request was successful (HTTP status code 200)
     if report_response.status_code == 200:
         # Parse the JSON response to retrieve report details
-        report_data = report_response.json()
+        report_data = sp_api.parse_json(report_response)
 
         # Fetch the IDs of reports that have already been downloaded to avoid re-downloading
         downloaded_reports = get_downloaded_report_ids()
 
-        # Iterate through the list of available reports
-        for report in report_data['reports']:
-            # Extract the report ID and its processing status
-            report_id = report['reportId']
-            processing_status = report['processingStatus']
-            data_start_time = report['dataStartTime']
-            data_end_time = report['dataEndTime']
-            
-            # Check if the report has been processed successfully (status is "DONE") 
-            # and if it hasn't been downloaded before
-            if processing_status == "DONE" and report_id not in downloaded_reports:
+        # Keep the reports that have been processed successfully (status is "DONE")
+        # and haven't been downloaded before
+        new_reports = [
+            report for report in report_data['reports']
+            if report['processingStatus'] == "DONE" and report['reportId'] not in downloaded_reports
+        ]
+
+        # Look up the next report's download URL while the current one downloads,
+        # and upload each report to the SMB share in the background
+        with ThreadPoolExecutor(max_workers=1) as prefetch_executor, \
+                ThreadPoolExecutor(max_workers=1) as upload_executor:
+            uploads = {}
+            next_url = prefetch_executor.submit(get_document_url, new_reports[0], access_token) if new_reports else None
+
+            for index, report in enumerate(new_reports):
+                report_id = report['reportId']
+                url_future = next_url
+                if index + 1 < len(new_reports):
+                    next_url = prefetch_executor.submit(get_document_url, new_reports[index + 1], access_token)
+
+                try:
+                    download_url, fetched_at = url_future.result()
+                    if time.monotonic() - fetched_at > DOCUMENT_URL_MAX_AGE:
+                        download_url, _ = get_document_url(report, access_token)
+                    local_file_path, remote_file_name = download_report(download_url, report_id, report['dataStartTime'], report['dataEndTime'])
+                    uploads[upload_executor.submit(smb_upload, local_file_path, remote_file_name)] = report_id
+                except Exception as e:
+                    print(f"Error processing report with ID {report_id}: {e}")
+
+            # Only log a report once its upload has finished
+            uploaded_reports = []
+            for upload in as_completed(uploads):
+                report_id = uploads[upload]
                 try:
-                    report_document_id = report['reportDocumentId']
-                    download_report(report_document_id, report_id, data_start_time, data_end_time, access_token)
-                    log_downloaded_report_id(report_id)
+                    upload.result()
+                    uploaded_reports.append(report_id)
                 except Exception as e:
                     print(f"Error processing report with ID {report_id}: {e}")
+
+        log_downloaded_report_ids(uploaded_reports)
    
   
     # If the request was not successful, print the error status code for debugging
@@ -163,15 +184,10 @@ def smb_upload(local_file_path, remote_file_name):
     """
     Upload a local file to the specified SMB share.
     """
-    conn = SMBConnection("", "", CLIENT_NAME, SERVER_NAME, use_ntlm_v2=True)
-    assert conn.connect(SERVER_NAME)
-
     with open(local_file_path, 'rb') as file_obj:
-        conn.storeFile(SHARE_NAME, SMB_PATH + '/' + remote_file_name, file_obj)
-
-    conn.close()
+        smb_store.store_file(file_obj, SERVER_NAME, SHARE_NAME, SMB_PATH + '/' + remote_file_name)
 
 
 if __name__ == "__main__":
-    token = get_access_token()
+    token = sp_api.get_access_token(SESSION)
     get_settlement_report(token)
\ No newline at end of file
@@ -1,11 +1,12 @@
 import csv
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
 from dotenv import load_dotenv
-from smb.SMBConnection import SMBConnection
 
-from credentials import credentials
+import smb_store
+import sp_api
 
 load_dotenv()
 
@@ -17,51 +18,42 @@ BASE_URL = 'https://sellingpartnerapi-na.amazon.com/fba/inbound/v0/shipments/'
 SERVER_NAME = os.getenv("NAS_SERVER_NAME")
 SHARE_NAME = os.getenv("NAS_SHARE_NAME")
 SMB_PATH = os.getenv("NAS_SHIPPMENTS_PATH")
-CLIENT_NAME = "local_machine"
 
+# Shipment item lists are fetched in parallel over one pooled, retrying session
+SESSION = sp_api.create_session()
+MAX_WORKERS = 8
 
-def get_access_token():
-    """
-    Obtain the access token for API authentication.
-    """
-    print("Attempting to obtain access token...")
-    token_response = requests.post(
-        "https://api.amazon.com/auth/o2/token",
-        data={
-            "grant_type": "refresh_token",
-            "refresh_token": os.getenv("REFRESH_TOKEN"),
-            "client_id": os.getenv("LWA_APP_ID"),
-            "client_secret": os.getenv("LWA_CLIENT_SECRET"),
-        },
-    )
-    print("Access Token Retrieved")
-    return token_response.json()["access_token"]
+# CSVs are uploaded in parallel, each upload thread holding its own SMB session
+SMB_UPLOAD_WORKERS = 4
 
 
 def get_downloaded_report_ids():
     """
     Fetch the list of already downloaded report IDs.
     """
-    # If the settlements-log.txt file doesn't exist, return an empty set.
+    # If the shipments-log.txt file exists, read it line by line,
+    # and each line is considered a report ID.
+    # If it doesn't exist yet, return an empty set.
     log_file = os.path.join(BASE_DIR, "shipments-log.txt")  # Adjusted path
-    if not os.path.exists(log_file):
+    try:
+        with open(log_file, "r") as f:
+            return set(f.read().splitlines())
+    except FileNotFoundError:
         return set()
 
-    # If the settlements-log.txt file exists, read it line by line,
-    # and each line is considered a report ID.
-    with open(log_file, "r") as f:
-        return set(f.read().splitlines())
-
 
-def log_downloaded_report_id(report_id):
+def log_downloaded_report_ids(report_ids):
     """
-    Log a report ID to the external file.
+    Log report IDs to the external file in a single write.
     """
+    if not report_ids:
+        return
+
     # Open the "shipments-log.txt" file in append mode.
     # If the file doesn't exist, it will be created.
     log_file = os.path.join(BASE_DIR, "shipments-log.txt")  # Adjusted path
     with open(log_file, "a") as f:
-        f.write(report_id + "\n")
+        f.write("\n".join(report_ids) + "\n")
 
 
 def get_shipment_ids(access_token):
@@ -78,13 +70,14 @@ def get_shipment_ids(access_token):
         "ShipmentStatusList": "WORKING,READY_TO_SHIP",  # Include both statuses
     }
 
-    response = requests.get(BASE_URL, headers=headers, params=params)
+    sp_api.rate_limit("getShipments")
+    response = SESSION.get(BASE_URL, headers=headers, params=params)
 
     if response.status_code != 200:
-        print(response.json())
+        print(sp_api.parse_json(response))
         response.raise_for_status()
 
-    shipments = response.json()
+    shipments = sp_api.parse_json(response)
 
     # Adjusting the shipment_ids extraction based on the provided structure
     shipment_data = shipments.get("payload", {}).get("ShipmentData", [])
@@ -106,30 +99,24 @@ def get_shipment_items(access_token, shipment_id):
     # Construct the URL for fetching items of a specific shipment ID
     url = f"{BASE_URL}{shipment_id}/items"
 
-    response = requests.get(url, headers=headers)
+    sp_api.rate_limit("getShipmentItemsByShipmentId")
+    response = SESSION.get(url, headers=headers)
 
     if response.status_code != 200:
-        print(response.json())
+        print(sp_api.parse_json(response))
         response.raise_for_status()
 
-    return response.json()
+    return sp_api.parse_json(response)
 
 
 def save_to_smb(local_file_path, smb_file_name):
     """
     Save a local file to the specified SMB location.
     """
-    # Establish a connection to the SMB server without authentication
-    smb_conn = SMBConnection(
-        "", "", CLIENT_NAME, SERVER_NAME, use_ntlm_v2=True, is_direct_tcp=True)
-    smb_conn.connect(SERVER_NAME)
-
+    # Uploads reuse one SMB session to the server without authentication
     with open(local_file_path, 'rb') as file:
-        smb_conn.storeFile(SHARE_NAME, os.path.join(
-            SMB_PATH, smb_file_name), file)
-
-    # Close the connection
-    smb_conn.close()
+        smb_store.store_file(file, SERVER_NAME, SHARE_NAME, os.path.join(
+            SMB_PATH, smb_file_name))
 
 # def save_to_tsv(data, shipment_id, folder_name="shipment-downloads", filename_prefix="shipment"):
 #     """
@@ -165,13 +152,31 @@ def save_to_smb(local_file_path, smb_file_name):
 #             ])
 
 
+def item_row(item):
+    """
+    Flatten a shipment item into a row of the shipment CSV.
+    """
+    prep_details = item['PrepDetailsList'][0] if item.get(
+        'PrepDetailsList') else {}
+    return (
+        item.get('ShipmentId', ''),
+        item.get('SellerSKU', ''),
+        item.get('FulfillmentNetworkSKU', ''),
+        item.get('QuantityShipped', ''),
+        item.get('QuantityReceived', ''),
+        item.get('QuantityInCase', ''),
+        prep_details.get('PrepInstruction', ''),
+        prep_details.get('PrepOwner', '')
+    )
+
+
 def save_to_csv(data, shipment_id, folder_name="shipment-downloads", filename_prefix="shipment"):
     """
     Save the provided data to a CSV file inside the specified folder, with the shipment ID appended.
+    Return the local path and file name of the CSV.
     """
     folder_path = os.path.join(BASE_DIR, folder_name)
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+    os.makedirs(folder_path, exist_ok=True)
 
     filename = f"{filename_prefix}_{shipment_id}.csv"
     file_path = os.path.join(folder_path, filename)
@@ -181,41 +186,69 @@ def save_to_csv(data, shipment_id, folder_name="shipment-downloads", filename_pr
         headers = ['ShipmentId', 'SellerSKU', 'FulfillmentNetworkSKU', 'QuantityShipped',
                    'QuantityReceived', 'QuantityInCase', 'PrepInstruction', 'PrepOwner']
         writer.writerow(headers)
+        writer.writerows([item_row(item) for item in data])
 
-        for item in data:
-            prep_details = item['PrepDetailsList'][0] if item.get(
-                'PrepDetailsList') else {}
-            writer.writerow([
-                item.get('ShipmentId', ''),
-                item.get('SellerSKU', ''),
-                item.get('FulfillmentNetworkSKU', ''),
-                item.get('QuantityShipped', ''),
-                item.get('QuantityReceived', ''),
-                item.get('QuantityInCase', ''),
-                prep_details.get('PrepInstruction', ''),
-                prep_details.get('PrepOwner', '')
-            ])
+    return file_path, filename
 
-    save_to_smb(file_path, filename)
 
-    # Saving to SMB location after saving it locally
-    save_to_smb(file_path, filename)
+def download_shipment(access_token, shipment_id):
+    """
+    Fetch the items of a shipment and save them to a local CSV.
+    Return the local path and file name of the CSV.
+    """
+    items = get_shipment_items(access_token, shipment_id)
+    return save_to_csv(items.get('payload', {}).get('ItemData', []), shipment_id)
 
 
 def main():
-    access_token = get_access_token()
+    access_token = sp_api.get_access_token(SESSION)
 
     # Fetching the list of shipment IDs that were already downloaded
     downloaded_shipment_ids = get_downloaded_report_ids()
 
     shipment_ids = get_shipment_ids(access_token)
 
-    for shipment_id in shipment_ids:
-        if shipment_id not in downloaded_shipment_ids:
-            items = get_shipment_items(access_token, shipment_id)
-            save_to_csv(items.get('payload', {}).get(
-                'ItemData', []), shipment_id)
-            log_downloaded_report_id(shipment_id)
+    # Log every shipment whose CSV reached the share, even if the run stops early
+    uploaded_shipment_ids = []
+    failures = 0
+    try:
+        # Each worker fetches a shipment and writes its CSV, so the main thread only hands files to the uploaders
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+                ThreadPoolExecutor(max_workers=SMB_UPLOAD_WORKERS) as upload_executor:
+            futures = {
+                executor.submit(download_shipment, access_token, shipment_id): shipment_id
+                for shipment_id in shipment_ids
+                if shipment_id not in downloaded_shipment_ids
+            }
+            uploads = {}
+            for future in as_completed(futures):
+                shipment_id = futures[future]
+                try:
+                    file_path, filename = future.result()
+                except Exception as e:
+                    print(f"Error processing shipment with ID {shipment_id}: {e}")
+                    failures += 1
+                    continue
+
+                # Saving to SMB location after saving it locally
+                uploads[upload_executor.submit(save_to_smb, file_path, filename)] = shipment_id
+
+            # Only log a shipment once its CSV has reached the share
+            for upload in as_completed(uploads):
+                shipment_id = uploads[upload]
+                try:
+                    upload.result()
+                    uploaded_shipment_ids.append(shipment_id)
+                except Exception as e:
+                    print(f"Error uploading shipment with ID {shipment_id}: {e}")
+                    failures += 1
+    finally:
+        log_downloaded_report_ids(uploaded_shipment_ids)
+
+    # Let the scheduler see the run as failed; the missing shipments are retried next time
+    if failures:
+        print(f"{failures} shipment(s) failed")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
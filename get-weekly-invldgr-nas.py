@@ -1,50 +1,45 @@
 import datetime
-import gzip
-import time
-from io import BytesIO
+import os
 from os.path import join
 
-import requests
+from dotenv import load_dotenv
 from smb.SMBConnection import SMBConnection
 
-from credentials import credentials
+import smb_store
+import sp_api
+
+load_dotenv()
+
+# SMB Constants
+SERVER_NAME = os.getenv("NAS_SERVER_NAME", "nas-bw-02.cfinc.com")
+SHARE_NAME = os.getenv("NAS_SHARE_NAME", "Filestore_NC")
+SMB_PATH = os.getenv("NAS_WEEKLY_LEDGER_PATH", r"Amazon Downloads\Weekly Inventory Ledger")
 
 # --- API FUNCTIONS ---
 
-def get_access_token():
+def get_lwa_credentials():
     """
-    Obtain the access token for authenticating with the API.
+    Return the (refresh_token, client_id, client_secret) to authenticate with.
+    They come from .env when set there, otherwise from the credentials module.
     """
-    # Request token from Amazon
-    token_response = requests.post(
-        "https://api.amazon.com/auth/o2/token",
-        data={
-            "grant_type": "refresh_token",
-            "refresh_token": credentials["refresh_token"],
-            "client_id": credentials["lwa_app_id"],
-            "client_secret": credentials["lwa_client_secret"],
-        },
-    )
-    print("Access Token Retrieved")
-    return token_response.json()["access_token"]
-
-
-def create_report(access_token):
+    if sp_api.REFRESH_TOKEN and sp_api.LWA_APP_ID and sp_api.LWA_CLIENT_SECRET:
+        return sp_api.REFRESH_TOKEN, sp_api.LWA_APP_ID, sp_api.LWA_CLIENT_SECRET
+
+    # credentials.py is not part of every deployment, so only import it when it is needed
+    from credentials import credentials
+    return credentials["refresh_token"], credentials["lwa_app_id"], credentials["lwa_client_secret"]
+
+
+# --- REPORT SPEC ---
+
+def build_spec():
     """
-    Create a report based on a given date range (from last Tuesday to current Monday).
+    Report on a given date range (from last Tuesday to current Monday).
     If the range crosses two months, adjust the end_date to the last day of the start month.
     """
-    endpoint = "https://sellingpartnerapi-na.amazon.com"
-    headers = {
-        "x-amz-access-token": access_token,
-        "Content-Type": "application/json"
-    }
-
     # Determine the range from last Tuesday to current Monday
     today = datetime.date.today()
-    end_date = today
-    while end_date.weekday() != 0:  # 0 is Monday
-        end_date -= datetime.timedelta(days=1)
+    end_date = today - datetime.timedelta(days=today.weekday())  # weekday() is 0 on Monday
     start_date = end_date - datetime.timedelta(days=6)
 
     # Adjust the date range if it spans two months
@@ -54,91 +49,7 @@ def create_report(access_token):
 
     print(f"Weekly Report:\nStart Date: {start_date}\nEnd Date: {end_date}")
 
-    # Set up payload and request report creation
-    payload = {
-        "reportType": "GET_LEDGER_SUMMARY_VIEW_DATA",
-        "dataStartTime": start_date.isoformat(),
-        "dataEndTime": end_date.isoformat(),
-        "marketplaceIds": ["ATVPDKIKX0DER"],
-        "reportOptions": {
-            "aggregateByLocation": "FC",  # Aggregate by FC
-            "aggregatedByTimePeriod": "DAILY"  # Aggregate daily
-        }
-    }
-    report_creation_response = requests.post(
-        endpoint + "/reports/2021-06-30/reports",
-        headers=headers,
-        json=payload
-    )
-
-    # Handle response and potential errors
-    if report_creation_response.status_code == 202:
-        print("Report creation started successfully and is being processed.")
-    elif report_creation_response.status_code != 200:
-        print(f"Error creating report. Status code: {report_creation_response.status_code}")
-        print(report_creation_response.text)
-        report_creation_response.raise_for_status()
-
-    response_data = report_creation_response.json()
-    if "reportId" not in response_data:
-        print("Unexpected response:")
-        print(response_data)
-        raise ValueError("Response did not contain 'reportId'")
-    print(f"Report Creation Response: {response_data}")
-
-    return response_data["reportId"], start_date, end_date  # Return the report ID and the date range
-
-
-def poll_report_status(access_token, report_id):
-    """
-    Poll the status of a report using its report ID until its status is "DONE".
-    If the report processing fails, raise an exception.
-    """
-    endpoint = "https://sellingpartnerapi-na.amazon.com"
-    headers = {
-        "x-amz-access-token": access_token
-    }
-
-    print(f"Polling report with ID: {report_id}")
-    while True:
-        status_response = requests.get(
-            endpoint + f"/reports/2021-06-30/reports/{report_id}",
-            headers=headers
-        )
-        status_data = status_response.json()
-        report_status = status_data["processingStatus"]
-
-        if report_status == "DONE":
-            return status_data["reportDocumentId"]
-        elif report_status in ["CANCELLED", "FAILED"]:
-            raise Exception(f"Report processing failed with status {report_status}")
-
-        print(f"Report Status: {report_status}")
-        time.sleep(60)  # Check report status every minute
-
-
-def download_report(access_token, document_id):
-    """
-    Download the report's contents using its document ID.
-    """
-    endpoint = "https://sellingpartnerapi-na.amazon.com"
-    headers = {
-        "x-amz-access-token": access_token
-    }
-    document_response = requests.get(
-        endpoint + f"/reports/2021-06-30/documents/{document_id}",
-        headers=headers
-    )
-    download_url = document_response.json()["url"]
-    compressed_content = requests.get(download_url).content
-
-    # Decompress the report's contents
-    buffer = BytesIO(compressed_content)
-    with gzip.GzipFile(fileobj=buffer, mode='rb') as f:
-        report_content = f.read().decode('utf-8')
-    print(f"Downloaded Report with Document ID: {document_id}")
-
-    return report_content
+    return sp_api.ReportSpec(start_date, end_date)
 
 # --- SMB FUNCTIONS ---
 
@@ -161,14 +72,8 @@ def test_smb_connection(server_name, share_name):
 
 
 
-def save_to_tsv(report_content, server_name, share_name, smb_path, filename):
-    conn = SMBConnection("", "", "client_machine", server_name, use_ntlm_v2=True, is_direct_tcp=True)
-    
-    if not conn.connect(server_name, 445):
-        raise ConnectionError(f"Unable to connect to the server: {server_name}")
-
-    with BytesIO(report_content.encode('utf-8')) as file:
-        conn.storeFile(share_name, join(smb_path, filename), file)
+def save_to_tsv(report_file, server_name, share_name, smb_path, filename):
+    smb_store.store_file(report_file, server_name, share_name, join(smb_path, filename))
     
     print(f"Report saved as: {filename}")
 
@@ -190,30 +95,22 @@ def week_of_month(dt):
 # --- MAIN EXECUTION ---
 
 if __name__ == "__main__":
-    # Modify these variables accordingly for SMB connection
-    SERVER_NAME = "nas-bw-02.cfinc.com"
-    SHARE_NAME = "Filestore_NC"
-    SMB_PATH = "Amazon Downloads\Weekly Inventory Ledger"
-    
     # Test the SMB connection
     test_smb_connection(SERVER_NAME, SHARE_NAME)
 
     # Get the Amazon access token
-    access_token = get_access_token()
-
-    # Create a report and get its ID and date range
-    report_id, start_date, end_date = create_report(access_token)
+    session = sp_api.create_session()
+    access_token = sp_api.get_access_token(session, *get_lwa_credentials())
 
     # Calculate filename based on the start date
-    week_num = week_of_month(start_date)
-    month_year_str = start_date.strftime('%m-%Y')
+    spec = build_spec()
+    week_num = week_of_month(spec.start_date)
+    month_year_str = spec.start_date.strftime('%m-%Y')
     filename = f"amazonia_week{week_num}_{month_year_str}.tsv"
 
-    # Wait for the report to be ready
-    document_id = poll_report_status(access_token, report_id)
-
-    # Download the report content
-    report_content = download_report(access_token, document_id)
+    # Create the report and wait for it to be ready
+    document_id = sp_api.get_report_document_id(session, access_token, spec)
 
-    # Save the report to the specified SMB server with the calculated filename
-    save_to_tsv(report_content, SERVER_NAME, SHARE_NAME, SMB_PATH, filename)
\ No newline at end of file
+    # Decompress the report as it downloads and save it to the specified SMB server with the calculated filename
+    with sp_api.open_report(session, access_token, document_id) as report_file:
+        save_to_tsv(report_file, SERVER_NAME, SHARE_NAME, SMB_PATH, filename)
\ No newline at end of file
@@ -0,0 +1,142 @@
+"""
+Upload files to an SMB share, preferring smbprotocol's SMB 3 client over pysmb.
+
+pysmb only speaks SMB 2.0.2, which caps every WRITE request at 64 KiB, so a large
+report is sent as a long series of stop-and-wait round trips. smbprotocol negotiates
+SMB 3 with multi-credit writes, letting each request carry up to several MiB.
+When smbprotocol is not installed, uploads fall back to pysmb.
+
+Both clients keep their SMB session open for the life of the process, so uploading
+several files only pays for the connect, negotiate and tree connect once.
+"""
+import atexit
+import shutil
+import threading
+
+from smb.SMBConnection import SMBConnection
+
+try:
+    import smbclient
+    HAVE_SMBPROTOCOL = True
+except ImportError:
+    HAVE_SMBPROTOCOL = False
+
+WRITE_BUFFER_SIZE = 1 << 20
+
+# smbprotocol sessions are shared by all threads, so each one only needs registering once
+registered_sessions = set()
+registered_sessions_lock = threading.Lock()
+
+# pysmb connections are not thread-safe, so each thread keeps its own
+thread_state = threading.local()
+open_connections = []
+open_connections_lock = threading.Lock()
+
+
+def unc_path(server_name, share_name, path):
+    """
+    Build a \\\\server\\share\\path UNC path from a share-relative path.
+    """
+    parts = [part for part in path.replace("/", "\\").split("\\") if part]
+    return "\\\\" + "\\".join([server_name, share_name] + parts)
+
+
+def get_connection(server_name, username='', password='', domain=''):
+    """
+    Return this thread's pysmb connection to server_name, connecting on first use.
+    """
+    connections = getattr(thread_state, "connections", None)
+    if connections is None:
+        connections = thread_state.connections = {}
+
+    key = (server_name, username, domain)
+    conn = connections.get(key)
+    if conn is None:
+        conn = SMBConnection(username, password, "client_machine", server_name, domain=domain, use_ntlm_v2=True, is_direct_tcp=True)
+        if not conn.connect(server_name, 445):
+            raise ConnectionError(f"Unable to connect to the server: {server_name}")
+        connections[key] = conn
+        with open_connections_lock:
+            open_connections.append(conn)
+    return conn
+
+
+def discard_connection(server_name, username='', domain=''):
+    """
+    Close and forget this thread's connection to server_name so the next upload reconnects.
+    """
+    conn = getattr(thread_state, "connections", {}).pop((server_name, username, domain), None)
+    if conn is None:
+        return
+    with open_connections_lock:
+        open_connections.remove(conn)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def close_connections():
+    """
+    Close every pysmb connection opened by any thread.
+    """
+    with open_connections_lock:
+        for conn in open_connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        open_connections.clear()
+
+
+atexit.register(close_connections)
+
+
+def register_session(server_name, username='', password=''):
+    """
+    Log in to server_name over smbprotocol unless this process already has.
+    """
+    with registered_sessions_lock:
+        if (server_name, username) in registered_sessions:
+            return
+        # Sign only when the server requires it, the same as pysmb's default
+        smbclient.register_session(server_name, username=username, password=password, port=445,
+                                   auth_protocol="ntlm", require_signing=False)
+        registered_sessions.add((server_name, username))
+
+
+def discard_session(server_name, username=''):
+    """
+    Forget the smbprotocol session to server_name so the next upload logs in again.
+    """
+    with registered_sessions_lock:
+        registered_sessions.discard((server_name, username))
+    try:
+        smbclient.delete_session(server_name, port=445)
+    except Exception:
+        pass
+
+
+def store_file(file_obj, server_name, share_name, path, username='', password='', domain=''):
+    """
+    Upload the contents of file_obj to path on the given share.
+    """
+    if HAVE_SMBPROTOCOL:
+        if domain:
+            username = f"{domain}\\{username}"
+        register_session(server_name, username, password)
+        try:
+            with smbclient.open_file(unc_path(server_name, share_name, path), mode="wb",
+                                     buffering=WRITE_BUFFER_SIZE) as remote_file:
+                shutil.copyfileobj(file_obj, remote_file, WRITE_BUFFER_SIZE)
+        except Exception:
+            discard_session(server_name, username)
+            raise
+        return
+
+    conn = get_connection(server_name, username, password, domain)
+    try:
+        conn.storeFile(share_name, path, file_obj)
+    except Exception:
+        discard_connection(server_name, username, domain)
+        raise
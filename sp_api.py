@@ -0,0 +1,416 @@
+"""
+Selling Partner API helpers shared by the inventory ledger report scripts.
+"""
+import contextlib
+import datetime
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    HAVE_ORJSON = False
+
+load_dotenv()
+
+ENDPOINT = "https://sellingpartnerapi-na.amazon.com"
+MARKETPLACE_ID = "ATVPDKIKX0DER"
+LEDGER_REPORT_OPTIONS = {
+    "aggregateByLocation": "FC",  # Aggregate by FC
+    "aggregatedByTimePeriod": "DAILY"  # Aggregate daily
+}
+
+# LWA credentials, read once at import
+REFRESH_TOKEN = os.getenv("REFRESH_TOKEN")
+LWA_APP_ID = os.getenv("LWA_APP_ID")
+LWA_CLIENT_SECRET = os.getenv("LWA_CLIENT_SECRET")
+
+# Shared on-disk cache of LWA access tokens, one entry per set of credentials
+LWA_TOKEN_CACHE = os.path.expanduser("~/.cache/amazon_lwa.json")
+
+# Reports requested by these scripts, so a later run for the same date range can reuse them
+REPORT_LOG = os.path.expanduser("~/.cache/amazon_ledger_reports.json")
+
+# Amazon keeps reports for 90 days, so older log entries are dropped
+REPORT_RETENTION = datetime.timedelta(days=90)
+
+# Give up on a report that is still not ready after this many seconds
+POLL_MAX_WAIT = 30 * 60
+
+# Connect/read timeout in seconds for every API call
+REQUEST_TIMEOUT = 30
+
+# Attempts for a POST that keeps being throttled; urllib3's Retry never retries POSTs
+POST_THROTTLE_ATTEMPTS = 5
+
+
+@dataclass(frozen=True)
+class ReportSpec:
+    """
+    Date range and type of a report to request from the API.
+    """
+    start_date: datetime.date
+    end_date: datetime.date
+    report_type: str = "GET_LEDGER_SUMMARY_VIEW_DATA"
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that applies REQUEST_TIMEOUT to requests made without an explicit timeout.
+    """
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = REQUEST_TIMEOUT
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket that delays callers to stay within an SP-API operation's rate limit.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve a token now, even if that leaves the bucket in debt, and wait the debt out
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Documented rate (requests/second) and burst of each SP-API operation the scripts call
+RATE_LIMITERS = {
+    "createReport": RateLimiter(0.0167, 15),
+    "getReports": RateLimiter(0.0222, 10),
+    "getReport": RateLimiter(2.0, 15),
+    "getReportDocument": RateLimiter(0.0167, 15),
+    "getShipments": RateLimiter(2.0, 30),
+    "getShipmentItemsByShipmentId": RateLimiter(2.0, 30),
+}
+
+
+def rate_limit(operation):
+    """
+    Wait until another call to the named SP-API operation is allowed.
+    """
+    RATE_LIMITERS[operation].acquire()
+
+
+def parse_json(response):
+    """
+    Decode a JSON response body, using orjson when it is installed.
+    """
+    if HAVE_ORJSON:
+        return orjson.loads(response.content)
+    return response.json()
+
+
+def create_session():
+    """
+    Build a session that keeps HTTPS connections to Amazon open between calls
+    and retries throttled or failed requests.
+    """
+    session = requests.Session()
+    session.mount("https://", TimeoutHTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+    ))
+    return session
+
+
+def post_throttled(session, url, **kwargs):
+    """
+    POST to url, waiting out 429 responses and trying again.
+    Only throttled requests are retried: Amazon did not act on them, whereas
+    retrying other failures could create a report twice.
+    """
+    delay = 1.0
+    for attempt in range(POST_THROTTLE_ATTEMPTS):
+        response = session.post(url, **kwargs)
+        if response.status_code != 429 or attempt == POST_THROTTLE_ATTEMPTS - 1:
+            return response
+
+        retry_after = response.headers.get("Retry-After", "")
+        print(f"Request to {url} throttled, retrying")
+        time.sleep(int(retry_after) if retry_after.isdigit() else delay)
+        delay *= 2
+
+
+def get_access_token(session, refresh_token=REFRESH_TOKEN, client_id=LWA_APP_ID, client_secret=LWA_CLIENT_SECRET):
+    """
+    Obtain the access token for authenticating with the API, using the LWA
+    credentials from .env unless others are given.
+    The token is cached on disk and reused until a minute before it expires.
+    """
+    # Key the cached token by the credentials so scripts run with another app's .env never share it
+    cache_key = hashlib.sha256(f"{client_id}:{refresh_token}".encode()).hexdigest()
+
+    os.makedirs(os.path.dirname(LWA_TOKEN_CACHE), exist_ok=True)
+    fd = os.open(LWA_TOKEN_CACHE, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as cache:
+        # Lock the cache so scripts running at the same time share a single token
+        fcntl.flock(cache, fcntl.LOCK_EX)
+        try:
+            tokens = json.load(cache)
+        except ValueError:
+            tokens = {}
+
+        # Drop expired tokens and anything not in the per-credentials format
+        now = time.time()
+        if not isinstance(tokens, dict):
+            tokens = {}
+        tokens = {key: entry for key, entry in tokens.items()
+                  if isinstance(entry, dict) and entry.get("exp", 0) > now}
+
+        cached = tokens.get(cache_key)
+        if cached and cached["exp"] - now > 60:
+            print("Access Token Retrieved from cache")
+            return cached["access_token"]
+
+        # Request token from Amazon
+        token_response = post_throttled(
+            session,
+            "https://api.amazon.com/auth/o2/token",
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": client_id,
+                "client_secret": client_secret,
+            },
+        )
+        token_data = parse_json(token_response)
+
+        tokens[cache_key] = {"access_token": token_data["access_token"], "exp": time.time() + token_data["expires_in"]}
+        cache.seek(0)
+        cache.truncate()
+        json.dump(tokens, cache)
+        print("Access Token Retrieved")
+        return token_data["access_token"]
+
+
+def create_report(session, access_token, spec):
+    """
+    Request creation of the report described by spec and return its report ID.
+    """
+    headers = {
+        "x-amz-access-token": access_token,
+        "Content-Type": "application/json"
+    }
+
+    # Set up payload and request report creation
+    payload = {
+        "reportType": spec.report_type,
+        "dataStartTime": spec.start_date.isoformat(),
+        "dataEndTime": spec.end_date.isoformat(),
+        "marketplaceIds": [MARKETPLACE_ID],
+        "reportOptions": LEDGER_REPORT_OPTIONS
+    }
+    rate_limit("createReport")
+    report_creation_response = post_throttled(
+        session,
+        ENDPOINT + "/reports/2021-06-30/reports",
+        headers=headers,
+        json=payload
+    )
+
+    # Handle response and potential errors
+    if report_creation_response.status_code == 202:
+        print("Report creation started successfully and is being processed.")
+    elif report_creation_response.status_code != 200:
+        print(f"Error creating report. Status code: {report_creation_response.status_code}")
+        print(report_creation_response.text)
+        report_creation_response.raise_for_status()
+
+    response_data = parse_json(report_creation_response)
+    if "reportId" not in response_data:
+        print("Unexpected response:")
+        print(response_data)
+        raise ValueError("Response did not contain 'reportId'")
+    print(f"Report Creation Response: {response_data}")
+
+    return response_data["reportId"]
+
+
+def report_key(spec):
+    """
+    Key under which the report described by spec is recorded in REPORT_LOG.
+    """
+    return f"{spec.report_type}:{spec.start_date.isoformat()}:{spec.end_date.isoformat()}"
+
+
+def record_report(spec, report_id):
+    """
+    Remember that report_id was requested for spec.
+    """
+    os.makedirs(os.path.dirname(REPORT_LOG), exist_ok=True)
+    fd = os.open(REPORT_LOG, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "r+") as log:
+        # Lock the log so scripts running at the same time do not drop each other's entries
+        fcntl.flock(log, fcntl.LOCK_EX)
+        try:
+            reports = json.load(log)
+        except ValueError:
+            reports = {}
+
+        oldest = (datetime.date.today() - REPORT_RETENTION).isoformat()
+        reports = {key: entry for key, entry in reports.items() if entry["endDate"] >= oldest}
+        reports[report_key(spec)] = {"reportId": report_id, "endDate": spec.end_date.isoformat()}
+
+        log.seek(0)
+        log.truncate()
+        json.dump(reports, log)
+
+
+def find_report(session, access_token, spec):
+    """
+    Look up the report these scripts last requested for spec, such as one
+    requested by another script or an earlier run.
+    Return its report ID if it is finished or still processing, or None if there is none to reuse.
+    """
+    try:
+        with open(REPORT_LOG) as log:
+            fcntl.flock(log, fcntl.LOCK_SH)
+            entry = json.load(log).get(report_key(spec))
+    except (FileNotFoundError, ValueError):
+        entry = None
+    if entry is None:
+        return None
+
+    report_id = entry["reportId"]
+    rate_limit("getReport")
+    status_response = session.get(
+        ENDPOINT + f"/reports/2021-06-30/reports/{report_id}",
+        headers={"x-amz-access-token": access_token}
+    )
+    if status_response.status_code != 200:
+        print(f"Error checking report {report_id}. Status code: {status_response.status_code}")
+        return None
+    if parse_json(status_response)["processingStatus"] in ["CANCELLED", "FAILED"]:
+        return None
+
+    print(f"Reusing report with ID: {report_id}")
+    return report_id
+
+
+def poll_report_status(session, access_token, report_id):
+    """
+    Poll the status of a report using its report ID until its status is "DONE".
+    If the report processing fails, raise an exception.
+    """
+    headers = {
+        "x-amz-access-token": access_token
+    }
+
+    print(f"Polling report with ID: {report_id}")
+    delay = 5.0
+    deadline = time.monotonic() + POLL_MAX_WAIT
+    while True:
+        rate_limit("getReport")
+        status_response = session.get(
+            ENDPOINT + f"/reports/2021-06-30/reports/{report_id}",
+            headers=headers
+        )
+
+        # Throttled responses carry Retry-After instead of a report status
+        retry_after = ""
+        if status_response.status_code in (429, 503):
+            print(f"Report status check throttled. Status code: {status_response.status_code}")
+            retry_after = status_response.headers.get("Retry-After", "")
+        else:
+            status_response.raise_for_status()
+
+            status_data = parse_json(status_response)
+            report_status = status_data["processingStatus"]
+
+            if report_status == "DONE":
+                return status_data["reportDocumentId"]
+            elif report_status in ["CANCELLED", "FAILED"]:
+                raise Exception(f"Report processing failed with status {report_status}")
+
+            print(f"Report Status: {report_status}")
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Report {report_id} was not ready after {POLL_MAX_WAIT} seconds")
+
+        # Wait as long as Amazon asks, otherwise back off exponentially with +/-20% jitter, capped at a minute
+        if retry_after.isdigit():
+            time.sleep(int(retry_after))
+        else:
+            time.sleep(delay * (0.8 + 0.4 * random.random()))
+        delay = min(delay * 1.5, 60.0)
+
+
+@contextlib.contextmanager
+def open_report(session, access_token, document_id):
+    """
+    Open the report's contents as a file object that is decompressed as it downloads.
+    """
+    headers = {
+        "x-amz-access-token": access_token
+    }
+    rate_limit("getReportDocument")
+    document_response = session.get(
+        ENDPOINT + f"/reports/2021-06-30/documents/{document_id}",
+        headers=headers
+    )
+    download_url = parse_json(document_response)["url"]
+
+    # Decompress the report as it streams in instead of buffering the compressed body first
+    with session.get(download_url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = False
+        with gzip.GzipFile(fileobj=response.raw, mode='rb') as f:
+            yield f
+    print(f"Downloaded Report with Document ID: {document_id}")
+
+
+def download_report(session, access_token, document_id):
+    """
+    Download the report's contents using its document ID.
+    """
+    with open_report(session, access_token, document_id) as f:
+        return f.read()
+
+
+def get_report_document_id(session, access_token, spec):
+    """
+    Return the document ID of the report described by spec.
+    A report these scripts already requested for spec is reused; otherwise
+    the report is created. Either way it is polled until it is ready.
+    """
+    report_id = find_report(session, access_token, spec)
+    if report_id is None:
+        report_id = create_report(session, access_token, spec)
+        record_report(spec, report_id)
+    return poll_report_status(session, access_token, report_id)
+
+
+def fetch_report(session, access_token, spec):
+    """
+    Return the decompressed contents of the report described by spec.
+    """
+    document_id = get_report_document_id(session, access_token, spec)
+    return download_report(session, access_token, document_id)
@@ -0,0 +1,45 @@
+import importlib.util
+import os
+import sys
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import smb_store  # noqa: E402
+
+
+def load_shipments():
+    """
+    Import get-shipments.py, whose hyphenated name rules out a plain import.
+    """
+    spec = importlib.util.spec_from_file_location("get_shipments", os.path.join(ROOT_DIR, "get-shipments.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_main_uploads_each_shipment_once(tmp_path, monkeypatch):
+    shipments = load_shipments()
+    shipment_ids = ["FBA001", "FBA002", "FBA003"]
+
+    monkeypatch.setattr(shipments, "BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(shipments, "SERVER_NAME", "nas")
+    monkeypatch.setattr(shipments, "SHARE_NAME", "share")
+    monkeypatch.setattr(shipments, "SMB_PATH", "shipments")
+    monkeypatch.setattr(shipments.sp_api, "get_access_token", lambda session: "token")
+    monkeypatch.setattr(shipments, "get_shipment_ids", lambda access_token: shipment_ids)
+    monkeypatch.setattr(shipments, "get_shipment_items",
+                        lambda access_token, shipment_id: {"payload": {"ItemData": [{"ShipmentId": shipment_id}]}})
+    monkeypatch.setattr(smb_store, "HAVE_SMBPROTOCOL", False)
+
+    with mock.patch.object(smb_store, "SMBConnection") as smb_connection:
+        smb_connection.return_value.connect.return_value = True
+        try:
+            shipments.main()
+        finally:
+            smb_store.close_connections()
+
+    assert smb_connection.return_value.storeFile.call_count == len(shipment_ids)
+    with open(tmp_path / "shipments-log.txt") as f:
+        assert sorted(f.read().splitlines()) == shipment_ids